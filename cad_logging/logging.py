@@ -1,21 +1,83 @@
-import getpass
+import atexit
+import functools
+import gzip
+import io
+import json
+import locale
 import logging
 import os
+import queue
+import shutil
 import socket
 import sys
-from contextlib import suppress
+import threading
+import time
+import weakref
 from datetime import datetime
-from logging.handlers import RotatingFileHandler
-from urllib.parse import urljoin
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
-import requests
+_HOSTNAME = socket.gethostname()
+
+# Objects whose background threads have to be restarted in forked children
+_fork_aware = weakref.WeakSet()
+
+
+def _before_fork():
+    for obj in list(_fork_aware):
+        before_fork = getattr(obj, "_before_fork", None)
+        if before_fork is not None:
+            before_fork()
+
+
+def _after_fork_in_child():
+    for obj in list(_fork_aware):
+        obj._after_fork_in_child()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(before=_before_fork, after_in_child=_after_fork_in_child)
+
+
+class _CachingFormatter(logging.Formatter):
+    """Formatter that returns its earlier output when a record is formatted again"""
+
+    def format(self, record):
+        cached = record.__dict__.get("_cad_formatted")
+        if cached is not None and cached[0] == id(self):
+            return cached[1]
+
+        s = super().format(record)
+        record._cad_formatted = (id(self), s)
+        return s
 
 
 class CustomRotatingFileHandler(RotatingFileHandler):
+    """Size-rotating file handler writing through a 64 KiB buffer
+
+    Records are encoded once and written to a BufferedWriter. The buffer is
+    flushed immediately for ERROR and above, otherwise by a flusher thread at
+    most flush_interval seconds later. With compress=True rotated files
+    are gzipped on a background thread.
+    """
+
     def __init__(
-        self, filename, mode="a", maxBytes=0, encoding=None, delay=False
+        self,
+        filename,
+        mode="a",
+        maxBytes=0,
+        encoding=None,
+        delay=False,
+        flush_interval=0.1,
+        compress=False,
     ):
         self.last_backup_cnt = 0
+        self.flush_interval = flush_interval
+        self.compress = compress
+        self._flusher = None
+        self._flush_stop = threading.Event()
+        self._dirty = False
+        self._write_through = False
+        self._rotate_lock = threading.Lock()
         super().__init__(
             filename=filename,
             mode=mode,
@@ -24,6 +86,49 @@ class CustomRotatingFileHandler(RotatingFileHandler):
             encoding=encoding,
             delay=delay,
         )
+        # Text mode would resolve a missing encoding ("locale" on 3.10+) to the
+        # locale's preferred encoding; records are encoded by hand, so do it here
+        if self.encoding in (None, "locale"):
+            self.encoding = locale.getpreferredencoding(False)
+        _fork_aware.add(self)
+
+    # override
+    def _open(self):
+        raw = open(self.baseFilename, self.mode + "b", buffering=0)
+        # Track the file size ourselves, BufferedWriter.tell() costs an lseek()
+        self._size = raw.tell()
+        return io.BufferedWriter(raw, buffer_size=65536)
+
+    # override
+    def emit(self, record):
+        try:
+            data = (self.format(record) + self.terminator).encode(
+                self.encoding, self.errors or "strict"
+            )
+            if self.stream is not None and self.maxBytes > 0:
+                if self._size and self._size + len(data) >= self.maxBytes:
+                    self.doRollover()
+            if self.stream is None:
+                self.stream = self._open()
+
+            self.stream.write(data)
+            self._size += len(data)
+            if record.levelno >= logging.ERROR or self._write_through:
+                self.stream.flush()
+            else:
+                self._dirty = True
+                if self._flusher is None:
+                    self._flusher = threading.Thread(
+                        target=self._flush_loop, name="LogFileFlusher", daemon=True
+                    )
+                    self._flusher.start()
+        except Exception:
+            self.handleError(record)
+
+    # override
+    def close(self):
+        self._flush_stop.set()
+        super().close()
 
     # override
     def doRollover(self):
@@ -34,43 +139,371 @@ class CustomRotatingFileHandler(RotatingFileHandler):
         self.last_backup_cnt += 1
         nextName = "%s.%d" % (self.baseFilename, self.last_backup_cnt)
         self.rotate(self.baseFilename, nextName)
+        if self.compress:
+            threading.Thread(target=self._compress, args=(nextName,)).start()
         # my code ends here
         if not self.delay:
             self.stream = self._open()
 
+    def _compress(self, path):
+        with self._rotate_lock:
+            try:
+                with open(path, "rb") as src, gzip.open(path + ".gz", "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+            except OSError:
+                # Keep the plain segment, drop what was written of the .gz
+                try:
+                    os.remove(path + ".gz")
+                except OSError:
+                    pass
+                return
+            os.remove(path)
+
+    def _before_fork(self):
+        # Otherwise the child inherits the unflushed buffer and writes it again
+        self.flush()
+
+    def _after_fork_in_child(self):
+        self._rotate_lock = threading.Lock()
+        self._flush_stop = threading.Event()
+        self._flusher = None
+        # multiprocessing children leave through os._exit(), which skips
+        # logging.shutdown(), so nothing may be left sitting in the buffer
+        self._write_through = True
+
+    def _flush_loop(self):
+        while not self._flush_stop.wait(self.flush_interval):
+            if self._dirty:
+                self._dirty = False
+                self.flush()
+
+
+class _QueueHandler(QueueHandler):
+    """QueueHandler that can hand records straight to its listener's handlers"""
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.listener = None
+
+    # override
+    def enqueue(self, record):
+        if self.listener is not None:
+            self.listener.handle(record)
+        else:
+            super().enqueue(record)
+
+
+class _QueueListener(QueueListener):
+    """QueueListener that handles records synchronously in forked children
+
+    multiprocessing children exit through os._exit(), so neither stop() nor
+    logging.shutdown() would get to write what is still queued in them.
+    """
+
+    def __init__(self, queue_handler, *handlers, respect_handler_level=False):
+        super().__init__(
+            queue_handler.queue, *handlers, respect_handler_level=respect_handler_level
+        )
+        self.queue_handler = queue_handler
+        _fork_aware.add(self)
+
+    # override
+    def stop(self):
+        if self._thread is not None:
+            super().stop()
+
+    def _after_fork_in_child(self):
+        if self._thread is None:
+            return
+        # Records the parent queued are the parent's to write
+        self._thread = None
+        self.queue_handler.listener = self
+
+
+@functools.lru_cache(maxsize=1)
+def _log_server_adapter():
+    """Returns the HTTPAdapter subclass used for log server connections
+
+    requests is imported here instead of at module level, so programs that
+    never log to the server don't pay for importing it.
+    """
+    from requests.adapters import HTTPAdapter
+
+    class LogServerAdapter(HTTPAdapter):
+        """HTTPAdapter whose pooled sockets send immediately and are kept alive"""
+
+        socket_options = [
+            (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+        ]
+
+        # override
+        def init_poolmanager(self, *args, **kwargs):
+            kwargs["socket_options"] = self.socket_options
+            super().init_poolmanager(*args, **kwargs)
+
+    return LogServerAdapter
+
+
+@functools.lru_cache(maxsize=1)
+def _entry_encoders():
+    """Returns the msgspec and orjson based entry encoders that are installed
+
+    Like requests they are only imported once a LogServerHandler is created.
+    Each encoder takes the handler and a batch and returns None for entries
+    it cannot encode (e.g. lone surrogates from surrogateescape).
+    """
+    encoders = []
+    try:
+        import msgspec
+    except ImportError:
+        pass
+    else:
+
+        class Entry(msgspec.Struct):
+            host: str
+            level: str
+            contents: str
+            source: str
+            user: str
+            timestamp: float
+
+        encode = msgspec.json.Encoder().encode
+
+        def encode_msgspec(handler, batch):
+            host, source, user = handler._host, handler.source, handler._user
+            entries = [
+                Entry(host, level, contents, source, user, timestamp)
+                for level, contents, timestamp in batch
+            ]
+            try:
+                return encode(entries[0] if len(entries) == 1 else entries)
+            except (msgspec.EncodeError, UnicodeEncodeError):
+                return None
+
+        encoders.append(encode_msgspec)
+
+    try:
+        import orjson
+    except ImportError:
+        pass
+    else:
+
+        def encode_orjson(handler, batch):
+            template = handler._template
+            entries = [
+                {**template, "level": level, "contents": contents, "timestamp": ts}
+                for level, contents, ts in batch
+            ]
+            try:
+                return orjson.dumps(entries[0] if len(entries) == 1 else entries)
+            except orjson.JSONEncodeError:
+                return None
+
+        encoders.append(encode_orjson)
+
+    return tuple(encoders)
+
+
+@functools.lru_cache(maxsize=1)
+def _default_server():
+    with open("/operations/app_store/python_diag/logging_server.txt", "r") as f:
+        return f.readline().strip()
+
+
+class LogServerHandler(logging.Handler):
+    """Sends log records to the C-AD logging server from a background thread
+
+    Records are queued by emit() and posted by a daemon worker, so logging
+    callers never wait on the network. The worker collects up to
+    CAD_LOG_BATCH_SIZE records (waiting at most CAD_LOG_BATCH_MS) per post;
+    with the default batch size of 1 each entry is posted on its own, larger
+    batches are posted as a JSON array. At most CAD_LOG_QUEUE entries are kept
+    waiting; beyond that new entries are dropped. After max_failures
+    consecutive failed posts the server is considered down and entries are
+    dropped without trying it for retry_after seconds. Lost entries are
+    reported in a summary entry once a post succeeds again. In children
+    forked from the process entries are posted synchronously by emit().
+    """
 
-class LogServerHandler(logging.StreamHandler):
     def __init__(self, server=None, source=None):
         if server is None:
-            with open("/operations/app_store/python_diag/logging_server.txt", "r") as f:
-                server = f.readline().strip()
+            server = _default_server()
 
-        self._entered = False
         self.server = server
         self.source = source or sys.argv[0] or "Unknown Python application"
+        self.batch_size = max(1, int(os.environ.get("CAD_LOG_BATCH_SIZE", 1)))
+        self.batch_interval = int(os.environ.get("CAD_LOG_BATCH_MS", 50)) / 1000
+        self.max_failures = 5
+        self.retry_after = 30.0
         super().__init__()
 
+        import getpass
+        from urllib.parse import urljoin
+
+        self._url = urljoin(self.server, "/api/entries/")
+        self._host = _HOSTNAME
+        self._user = getpass.getuser()
+        self._template = {"host": self._host, "source": self.source, "user": self._user}
+        self._prefix = b'{"host":%b,"source":%b,"user":%b,"level":' % (
+            json.dumps(self._host).encode(),
+            json.dumps(self.source).encode(),
+            json.dumps(self._user).encode(),
+        )
+        self.max_queue = int(os.environ.get("CAD_LOG_QUEUE", 5000))
+        self._fail_count = 0
+        self._open_until = 0.0
+        self._posting = False
+        self._encoders = _entry_encoders()
+        self._start()
+        _fork_aware.add(self)
+
     def emit(self, record: logging.LogRecord):
-        if self._entered:
+        if self._queue is None:
+            self._post_now(record)
+            return
+
+        # Records logged by the worker itself (e.g. by requests) would loop forever.
+        # Check the originating thread, emit() may run on a QueueListener thread.
+        if record.thread == self._worker_ident:
             return
 
-        self._entered = True
+        if self._queue.qsize() >= self.max_queue:
+            with self._dropped_lock:
+                self._dropped += 1
+            return
+
+        try:
+            self._queue.put((record.levelname, self.format(record), record.created))
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        # Give the worker a chance to post whatever is still queued
+        if self._worker is not None:
+            self._queue.put(None)
+            self._worker.join(timeout=5.0)
+        self._session.close()
+        super().close()
+
+    def _start(self):
+        self._session = self._new_session()
+        self._queue = queue.SimpleQueue()
+        self._dropped = 0
+        self._dropped_lock = threading.Lock()
+        self._worker = threading.Thread(
+            target=self._drain, name="LogServerHandler", daemon=True
+        )
+        self._worker.start()
+        self._worker_ident = self._worker.ident
+
+    def _new_session(self):
+        import requests
+        from urllib3.util.retry import Retry
+
+        session = requests.Session()
+        session.headers["Content-Type"] = "application/json"
+        adapter = _log_server_adapter()(
+            pool_connections=1,
+            pool_maxsize=4,
+            max_retries=Retry(total=0),
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def _after_fork_in_child(self):
+        # The parent keeps posting what it queued; its pooled connections must
+        # not be shared with it either, so start over with a new session.
+        # No worker: multiprocessing children exit through os._exit() and would
+        # lose whatever it still holds, so entries are posted by emit() instead.
+        self._session = self._new_session()
+        self._queue = None
+        self._worker = None
+        self._worker_ident = None
+
+    def _post_now(self, record):
+        # Runs with the handler lock held, so only records logged while posting
+        # (e.g. by requests) on this same thread can find _posting set
+        if self._posting:
+            return
+        self._posting = True
         try:
-            url = urljoin(self.server, "/api/entries/")
-            msg = self.format(record)
-            data = {
-                "host": socket.gethostname(),
-                "level": record.levelname,
-                "contents": msg,
-                "source": self.source,
-                "user": getpass.getuser(),
-                "timestamp": record.created,
-            }
-
-            with suppress(Exception):
-                requests.post(url, json=data)
+            self._post([(record.levelname, self.format(record), record.created)])
+        except Exception:
+            self.handleError(record)
         finally:
-            self._entered = False
+            self._posting = False
+
+    def _drain(self):
+        closing = False
+        while not closing:
+            entry = self._queue.get()
+            if entry is None:
+                return
+
+            batch = [entry]
+            deadline = time.monotonic() + self.batch_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    entry = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if entry is None:
+                    closing = True
+                    break
+                batch.append(entry)
+
+            with self._dropped_lock:
+                dropped, self._dropped = self._dropped, 0
+
+            if self._post(batch):
+                msg = f"{dropped} log entries dropped before reaching the log server"
+                if dropped and self._post([("WARNING", msg, time.time())]):
+                    dropped = 0
+            else:
+                dropped += len(batch)
+            if dropped:
+                with self._dropped_lock:
+                    self._dropped += dropped
+
+    def _encode(self, batch):
+        # msgspec and orjson reject some strings json accepts, so fall through
+        # to json when neither could encode the batch
+        for encode in self._encoders:
+            body = encode(self, batch)
+            if body is not None:
+                return body
+
+        # Only the per-record fields go through json, the rest is pre-encoded
+        prefix, dumps = self._prefix, json.dumps
+        entries = [
+            b'%b%b,"contents":%b,"timestamp":%r}'
+            % (prefix, dumps(level).encode(), dumps(contents).encode(), ts)
+            for level, contents, ts in batch
+        ]
+        return entries[0] if len(entries) == 1 else b"[" + b",".join(entries) + b"]"
+
+    def _post(self, batch):
+        # Don't wait on a server that is known to be down
+        if time.monotonic() < self._open_until:
+            return False
+
+        body = self._encode(batch)
+        try:
+            response = self._session.post(self._url, data=body, timeout=(1.0, 2.0))
+            response.raise_for_status()
+        except Exception:
+            self._fail_count += 1
+            if self._fail_count >= self.max_failures:
+                self._open_until = time.monotonic() + self.retry_after
+            return False
+
+        self._fail_count = 0
+        return True
 
 
 def enable_exception_handler():
@@ -94,6 +527,7 @@ def enable_logging(
     enable_db=True,
     db_level=logging.INFO,
     console_level=None,
+    fs_compress=False,
 ):
     """Enables the default C-AD logging configuration for Python programs
     Defaults to database logging, filesystem logging optional
@@ -105,6 +539,7 @@ def enable_logging(
         enable_db (bool, optional): Enables logging to database server. Defaults to True.
         db_level (int, optional): Log level to use for database handler. Defaults to INFO.
         console_level (int, optional): Log level to use for console handler. Defaults to WARNING.
+        fs_compress (bool, optional): Gzips rotated log files in the background. Defaults to False.
     """
     script_name = os.path.basename(sys.argv[0])
     if script_name == "__main__.py":
@@ -113,28 +548,35 @@ def enable_logging(
         path = pathlib.Path(sys.argv[0])
         script_name = path.parts[-2]
 
-    formatter = logging.Formatter(
+    formatter = _CachingFormatter(
         "%(asctime)s - %(levelname)s - %(pathname)s:%(lineno)s - %(message)s", style="%"
     )
+    # File and database handlers run on a QueueListener thread so that logging
+    # calls only pay for a queue put
+    handlers = []
     if enable_fs:
         if not fs_path:
-            hostname = socket.gethostname().replace(".pbn.bnl.gov", "")
+            hostname = _HOSTNAME.replace(".pbn.bnl.gov", "")
             logging_dir = f"/operations/app_store/{script_name}/diagnostics/message"
             ts = datetime.now().strftime("%Y-%m%d_%H:%M:%S")
             logging_file = f"{ts}_{hostname}:{os.getpid()}.log"
             fs_path = os.path.join(logging_dir, logging_file)
 
-        os.makedirs(os.path.dirname(fs_path), exist_ok=True)
+        logging_dir = os.path.dirname(fs_path)
+        if not os.path.isdir(logging_dir):
+            os.makedirs(logging_dir, exist_ok=True)
 
-        file_handler = CustomRotatingFileHandler(fs_path, maxBytes=1e6)
+        file_handler = CustomRotatingFileHandler(
+            fs_path, maxBytes=1e6, compress=fs_compress
+        )
         file_handler.setLevel(fs_level)
         file_handler.setFormatter(formatter)
-        logging.root.addHandler(file_handler)
+        handlers.append(file_handler)
 
     if enable_db:
         db_handler = LogServerHandler()
         db_handler.setLevel(db_level)
-        logging.root.addHandler(db_handler)
+        handlers.append(db_handler)
 
     if console_level is None:
         console_level = os.environ.get("LOGLEVEL", "WARNING")
@@ -147,6 +589,18 @@ def enable_logging(
     logging.root.setLevel(logging.DEBUG)
     logging.root.addHandler(console_handler)
 
+    # Added after the console handler so that a line the console already
+    # formatted is copied along with the record and reused by the file handler
+    if handlers:
+        log_queue = queue.Queue(-1)
+        # Records no listener handler wants are dropped before being queued
+        queue_handler = _QueueHandler(log_queue)
+        queue_handler.setLevel(min(handler.level for handler in handlers))
+        logging.root.addHandler(queue_handler)
+        listener = _QueueListener(queue_handler, *handlers, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+
     enable_exception_handler()
 
 
@@ -0,0 +1,147 @@
+import gzip
+import logging
+import os
+import pathlib
+import shutil
+import subprocess
+import sys
+import time
+
+import pytest
+
+from cad_logging.logging import CustomRotatingFileHandler
+
+ROOT = pathlib.Path(__file__).resolve().parents[1]
+
+
+def test_write_without_utf8_mode(tmp_path):
+    path = tmp_path / "message.log"
+    script = (
+        "import logging, sys\n"
+        "from cad_logging.logging import CustomRotatingFileHandler\n"
+        "handler = CustomRotatingFileHandler(sys.argv[1])\n"
+        "logging.getLogger().addHandler(handler)\n"
+        "logging.warning('hello')\n"
+        "handler.close()\n"
+    )
+    subprocess.run(
+        [sys.executable, "-X", "utf8=0", "-c", script, str(path)], cwd=ROOT, check=True
+    )
+
+    assert path.read_text() == "hello\n"
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs os.fork()")
+def test_enable_logging_in_forked_child(tmp_path):
+    path = tmp_path / "message.log"
+    script = (
+        "import logging, os, sys\n"
+        "from cad_logging import enable_logging\n"
+        "enable_logging(fs_path=sys.argv[1], enable_db=False, console_level=100)\n"
+        "logging.info('parent')\n"
+        "pid = os.fork()\n"
+        "if pid == 0:\n"
+        "    logging.info('child')\n"
+        "    sys.exit(0)\n"
+        "os.waitpid(pid, 0)\n"
+    )
+    subprocess.run([sys.executable, "-c", script, str(path)], cwd=ROOT, check=True)
+
+    messages = [line.rsplit(" - ", 1)[1] for line in path.read_text().splitlines()]
+    assert sorted(messages) == ["child", "parent"]
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs os.fork()")
+def test_enable_logging_in_multiprocessing_children(tmp_path):
+    path = tmp_path / "message.log"
+    script = (
+        "import logging, multiprocessing, sys\n"
+        "from cad_logging import enable_logging\n"
+        "def work(name):\n"
+        "    logging.info(name)\n"
+        "if __name__ == '__main__':\n"
+        "    enable_logging(fs_path=sys.argv[1], enable_db=False, console_level=100)\n"
+        "    ctx = multiprocessing.get_context('fork')\n"
+        "    procs = [ctx.Process(target=work, args=(f'process {i}',)) for i in range(3)]\n"
+        "    for proc in procs:\n"
+        "        proc.start()\n"
+        "    for proc in procs:\n"
+        "        proc.join()\n"
+        "    with ctx.Pool(2) as pool:\n"
+        "        pool.map(work, [f'task {i}' for i in range(4)])\n"
+    )
+    subprocess.run([sys.executable, "-c", script, str(path)], cwd=ROOT, check=True)
+
+    messages = [line.rsplit(" - ", 1)[1] for line in path.read_text().splitlines()]
+    assert sorted(messages) == [
+        "process 0",
+        "process 1",
+        "process 2",
+        "task 0",
+        "task 1",
+        "task 2",
+        "task 3",
+    ]
+
+
+def _rotating_handler(path, **kwargs):
+    handler = CustomRotatingFileHandler(str(path), **kwargs)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    return handler
+
+
+def _log(handler, msg):
+    handler.handle(logging.makeLogRecord({"msg": msg, "levelno": logging.INFO}))
+
+
+def test_compress_rotated_file(tmp_path):
+    path = tmp_path / "message.log"
+    handler = _rotating_handler(path, maxBytes=20, compress=True)
+    _log(handler, "first line")
+    _log(handler, "second line")
+    handler.close()
+
+    segment = tmp_path / "message.log.1"
+    compressed = tmp_path / "message.log.1.gz"
+    deadline = time.monotonic() + 5.0
+    while segment.exists() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    assert not segment.exists()
+    assert gzip.decompress(compressed.read_bytes()) == b"first line\n"
+    assert path.read_text() == "second line\n"
+
+
+def test_compress_failure_keeps_segment(tmp_path, monkeypatch):
+    def fail(*args, **kwargs):
+        raise OSError("disk full")
+
+    handler = _rotating_handler(tmp_path / "message.log", compress=True)
+    segment = tmp_path / "message.log.1"
+    segment.write_text("rotated\n")
+    monkeypatch.setattr(shutil, "copyfileobj", fail)
+    handler._compress(str(segment))
+    handler.close()
+
+    assert segment.read_text() == "rotated\n"
+    assert not (tmp_path / "message.log.1.gz").exists()
+
+
+def test_rotation_by_size(tmp_path):
+    path = tmp_path / "message.log"
+    existing = "x" * 44 + "\n"
+    path.write_text(existing)
+    handler = _rotating_handler(path, maxBytes=50)
+    lines = [f"line {i:02d}\n" for i in range(30)]
+    for line in lines:
+        _log(handler, line.rstrip("\n"))
+    handler.close()
+
+    # The size of the file being appended to counts towards the first rollover
+    assert (tmp_path / "message.log.1").read_text() == existing
+    assert (tmp_path / "message.log.2").exists()
+    segments = sorted(tmp_path.glob("message.log.*"), key=lambda p: int(p.suffix[1:]))
+    segments.append(path)
+    assert all(segment.stat().st_size < 50 for segment in segments)
+    written = "".join(segment.read_text() for segment in segments)
+    assert written == existing + "".join(lines)
@@ -0,0 +1,197 @@
+import json
+import logging
+import multiprocessing
+import os
+import pathlib
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import cad_logging.logging as cad_logging
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.bodies.append(json.loads(body))
+        self.server.received.set()
+        self.server.gate.wait()
+        self.send_response(self.server.status)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server(ThreadingHTTPServer):
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _RequestHandler)
+        self.url = f"http://127.0.0.1:{self.server_port}/"
+        self.bodies = []
+        self.status = 201
+        self.received = threading.Event()
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def entries(self):
+        entries = []
+        for body in self.bodies:
+            entries.extend(body if isinstance(body, list) else [body])
+        return entries
+
+
+@pytest.fixture
+def server():
+    srv = _Server()
+    thread = threading.Thread(target=srv.serve_forever, daemon=True)
+    thread.start()
+    yield srv
+    srv.gate.set()
+    srv.shutdown()
+    srv.server_close()
+
+
+def _log(handler, msg, level=logging.INFO):
+    record = logging.makeLogRecord(
+        {"msg": msg, "levelno": level, "levelname": logging.getLevelName(level)}
+    )
+    handler.handle(record)
+
+
+def test_single_entry_format(server):
+    handler = cad_logging.LogServerHandler(server=server.url, source="test")
+    _log(handler, "one")
+    _log(handler, "two", logging.WARNING)
+    handler.close()
+
+    assert [type(body) for body in server.bodies] == [dict, dict]
+    first, second = server.bodies
+    assert set(first) == {"host", "level", "contents", "source", "user", "timestamp"}
+    assert first["level"] == "INFO"
+    assert first["contents"] == "one"
+    assert first["source"] == "test"
+    assert (second["level"], second["contents"]) == ("WARNING", "two")
+    assert isinstance(first["timestamp"], float)
+
+
+def test_batch_format(server, monkeypatch):
+    monkeypatch.setenv("CAD_LOG_BATCH_SIZE", "3")
+    monkeypatch.setenv("CAD_LOG_BATCH_MS", "5000")
+    handler = cad_logging.LogServerHandler(server=server.url, source="test")
+    for msg in ("a", "b", "c"):
+        _log(handler, msg)
+    handler.close()
+
+    assert len(server.bodies) == 1
+    assert [entry["contents"] for entry in server.bodies[0]] == ["a", "b", "c"]
+
+
+def test_drop_summary(server, monkeypatch):
+    monkeypatch.setenv("CAD_LOG_QUEUE", "2")
+    handler = cad_logging.LogServerHandler(server=server.url, source="test")
+    server.gate.clear()
+    _log(handler, "first")
+    assert server.received.wait(2.0)
+
+    # The worker is stuck posting "first", two more fit in the queue
+    for i in range(9):
+        _log(handler, f"later {i}")
+    server.gate.set()
+    handler.close()
+
+    contents = [entry["contents"] for entry in server.entries()]
+    assert contents == [
+        "first",
+        "later 0",
+        "7 log entries dropped before reaching the log server",
+        "later 1",
+    ]
+
+
+def test_circuit_breaker(server):
+    handler = cad_logging.LogServerHandler(server=server.url, source="test")
+    handler.max_failures = 2
+    handler.retry_after = 0.5
+    server.status = 503
+    _log(handler, "fail 1")
+    _log(handler, "fail 2")
+    _log(handler, "skipped")
+    deadline = time.monotonic() + 2.0
+    while handler._open_until == 0.0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.1)
+
+    # Open: the third entry is dropped without contacting the server
+    assert len(server.bodies) == 2
+
+    server.status = 201
+    time.sleep(0.5)
+    _log(handler, "recovered")
+    handler.close()
+
+    contents = [entry["contents"] for entry in server.entries()]
+    assert contents[2:] == [
+        "recovered",
+        "3 log entries dropped before reaching the log server",
+    ]
+    assert handler._fail_count == 0
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs os.fork()")
+def test_multiprocessing_child(server):
+    handler = cad_logging.LogServerHandler(server=server.url, source="test")
+    ctx = multiprocessing.get_context("fork")
+    proc = ctx.Process(target=_log, args=(handler, "child"))
+    proc.start()
+    proc.join()
+    _log(handler, "parent")
+    handler.close()
+
+    # The child exits through os._exit(), its entry was posted synchronously
+    assert proc.exitcode == 0
+    contents = [entry["contents"] for entry in server.entries()]
+    assert sorted(contents) == ["child", "parent"]
+
+
+@pytest.mark.parametrize("encoder", ["msgspec", "orjson", "json"])
+def test_encoder_fallback(server, monkeypatch, encoder):
+    names = [encode.__name__ for encode in cad_logging._entry_encoders()]
+    if encoder != "json" and f"encode_{encoder}" not in names:
+        pytest.skip(f"{encoder} is not installed")
+
+    monkeypatch.setenv("CAD_LOG_BATCH_SIZE", "2")
+    monkeypatch.setenv("CAD_LOG_BATCH_MS", "5000")
+    handler = cad_logging.LogServerHandler(server=server.url, source='quote " src')
+    # Leave only the requested encoder and the ones it falls back to
+    first = names.index(f"encode_{encoder}") if encoder != "json" else len(names)
+    handler._encoders = handler._encoders[first:]
+    # Lone surrogates are rejected by msgspec and orjson, json still encodes them
+    _log(handler, "bad \udcff name")
+    _log(handler, "plain é")
+    handler.close()
+
+    assert len(server.bodies) == 1
+    assert [(entry["source"], entry["contents"]) for entry in server.bodies[0]] == [
+        ('quote " src', "bad \udcff name"),
+        ('quote " src', "plain é"),
+    ]
+    assert handler._fail_count == 0
+
+
+def test_import_is_lazy():
+    script = (
+        "import sys, cad_logging\n"
+        "print(sorted({'msgspec', 'orjson', 'requests'} & set(sys.modules)))\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", script],
+        cwd=pathlib.Path(__file__).resolve().parents[1],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert result.stdout == "[]\n"